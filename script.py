@@ -1,13 +1,23 @@
 import os
 import json
+import time
+import threading
 import datetime
-import pytz
-import geocoder
+import functools
+from types import MappingProxyType
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
 import requests
+from requests.adapters import HTTPAdapter
 import gradio as gr
-from babel.dates import format_datetime
+from babel.dates import format_datetime, format_date, format_time
 from babel import Locale
 
+# Use the faster orjson decoder when it is installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 
 # Define extension path (directory where the script is located)
 extension_path = os.path.dirname(os.path.abspath(__file__))
@@ -29,8 +39,79 @@ default_params = {
 
 params = default_params.copy()
 
-# Open Meteo weather code map
-weather_code_map = {
+# Label and Babel formatter for each (add_time, add_date) combination, so the
+# current time is formatted in a single call whichever parts are enabled
+datetime_formats = {
+    (True, True): ("Current date and time", format_datetime),
+    (True, False): ("Current time", format_time),
+    (False, True): ("Current date", format_date),
+}
+
+# Delay (seconds) used to coalesce bursts of settings changes into one write
+SAVE_DELAY = 0.5
+
+# How long fetched location and weather data stay valid (seconds)
+CACHE_TTL = 600
+WEATHER_TTL = 300
+
+# Cached location lookup and weather lookups keyed by rounded coordinates
+_cached_location = {"value": None, "expires": 0}
+_cached_weather = {}
+
+# Modification time and contents of settings.json when it was last read or written
+_settings_state = {"mtime": None, "params": None}
+
+# Serializes writers so they never share the temp file mid-write
+_write_lock = threading.Lock()
+
+# Pending delayed save, replaced whenever another change comes in
+_save_timer = {"timer": None}
+_save_lock = threading.Lock()
+
+# Timezone object for params["timezone"] and the name actually in effect,
+# rebuilt only when the setting changes
+_tz_cache = {"name": None, "tz": None, "display": None}
+
+# Parsed Babel locale for params["locale"], rebuilt only when the setting changes
+_locale_cache = {"name": None, "locale": None}
+
+# Shared HTTP session so repeated requests reuse kept-alive connections
+_http = requests.Session()
+_http.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
+# Open-Meteo current weather endpoint, filled with latitude and longitude
+WEATHER_URL_FMT = "https://api.open-meteo.com/v1/forecast?latitude=%s&longitude=%s&current_weather=true"
+
+# Let Open-Meteo serve cached responses as fresh as our own weather cache
+WEATHER_HEADERS = {"Cache-Control": f"max-age={WEATHER_TTL}"}
+
+# IP geolocation endpoint used to look up the current location
+IPINFO_URL = "https://ipinfo.io/json"
+
+# Connect and read timeouts (seconds) so a stalled API cannot block the chat
+HTTP_TIMEOUT = (2, 3)
+
+# How often (seconds) the background refresher updates location and weather
+REFRESH_INTERVAL = WEATHER_TTL
+
+# Shorter wait (seconds) before retrying after a failed lookup
+RETRY_INTERVAL = 20
+
+# Latest ((city, country, latlng), weather) from the refresher, replaced as a
+# whole so chat turns always read a consistent pair without waiting on the network
+_latest_context = {"value": None}
+
+# Background refresher thread, started at most once by setup()
+_refresher = {"thread": None}
+
+# Set to wake the refresher early when a relevant setting changes
+_refresh_event = threading.Event()
+
+# Settings that change what the refresher needs to fetch
+REFRESH_PARAMS = ("add_location", "add_weather", "temp_unit")
+
+# Open Meteo weather code map (read-only, shared by all lookups)
+weather_code_map = MappingProxyType({
     0: "Clear",
     1: "Mostly Clear",
     2: "Partly Cloudy",
@@ -59,27 +140,51 @@ weather_code_map = {
     95: "Thunderstorm: Slight or Moderate",
     96: "Thunderstorm With Light Hail",
     99: "Thunderstorm With Heavy Hail"
-}
+})
 
 
 def load_settings():
     """ Loads settings from settings.json or uses default if file does not exist. """
-    if os.path.exists(SETTINGS_FILE):
-        with open(SETTINGS_FILE, 'r') as f:
-            saved_params = json.load(f)
-        params.update(saved_params)
-    else:
+    try:
+        mtime = os.stat(SETTINGS_FILE).st_mtime
+    except FileNotFoundError:
         save_settings()
+        return
+
+    # Skip re-reading a file that has not changed since it was last loaded or saved,
+    # but still apply its values since params may have been changed in between
+    if mtime == _settings_state["mtime"] and _settings_state["params"] is not None:
+        saved_params = _settings_state["params"]
+    else:
+        with open(SETTINGS_FILE, 'rb') as f:
+            saved_params = json_loads(f.read())
+        _settings_state["mtime"] = mtime
+        _settings_state["params"] = saved_params
+    params.update(saved_params)
 
 
 def save_settings():
-    """ Saves current settings to settings.json. """
-    with open(SETTINGS_FILE, 'w') as f:
-        json.dump(params, f, indent=4)
+    """ Saves current settings to settings.json, replacing the file atomically. """
+    tmp_file = SETTINGS_FILE + ".tmp"
+    with _write_lock:
+        with open(tmp_file, 'w') as f:
+            json.dump(params, f, indent=4)
+        os.replace(tmp_file, SETTINGS_FILE)
+        _settings_state["mtime"] = os.stat(SETTINGS_FILE).st_mtime
+        _settings_state["params"] = dict(params)
     current_datetime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print(f"Settings were saved at {current_datetime}")
 
 
+def schedule_save():
+    """ Saves settings after SAVE_DELAY seconds, coalescing rapid changes into one write. """
+    with _save_lock:
+        if _save_timer["timer"] is not None:
+            _save_timer["timer"].cancel()
+        _save_timer["timer"] = threading.Timer(SAVE_DELAY, save_settings)
+        _save_timer["timer"].start()
+
+
 def setup():
     """ Initial setup for loading settings and saving defaults if necessary. """
     if not os.path.exists(SETTINGS_FILE):
@@ -87,25 +192,56 @@ def setup():
     else:
         load_settings()
 
+    # Keep location and weather up to date in the background so chat turns never wait on them.
+    # setup() runs at import and again from the extension loader, so only start one refresher
+    if _refresher["thread"] is None:
+        _refresher["thread"] = threading.Thread(target=refresh_context, daemon=True)
+        _refresher["thread"].start()
+
 
 def get_location():
-    """ Get location information using IP address. """
+    """ Get location information using IP address, cached for CACHE_TTL seconds. """
+    if _cached_location["value"] is not None and time.monotonic() < _cached_location["expires"]:
+        return _cached_location["value"]
+
     try:
-        g = geocoder.ip('me')
-        return g.city, g.country, g.latlng
+        response = _http.get(IPINFO_URL, timeout=HTTP_TIMEOUT)
+        data = json_loads(response.content)
+        lat, lon = map(float, data["loc"].split(","))
+        location = (data.get("city"), data.get("country"), [lat, lon])
     except Exception as e:
         return "Location unavailable", "Unknown", None
 
+    _cached_location["value"] = location
+    _cached_location["expires"] = time.monotonic() + CACHE_TTL
+    return location
+
 
 def get_weather(lat, lon):
+    """ Get the current weather for the given coordinates, cached for WEATHER_TTL seconds. """
     if lat is None or lon is None:
         return "Weather unavailable"
-    
+
+    # Round so small jitter in the coordinates reuses the same cache entry and URL
+    lat, lon = round(lat, 2), round(lon, 2)
+    key = (lat, lon, params["temp_unit"])
+    cached = _cached_weather.get(key)
+    if cached is not None and time.monotonic() < cached[0]:
+        return cached[1]
+
+    weather = _fetch_weather(lat, lon)
+    if weather != "Weather unavailable":
+        _cached_weather[key] = (time.monotonic() + WEATHER_TTL, weather)
+    return weather
+
+
+def _fetch_weather(lat, lon):
+    """ Fetch and format the current weather from Open-Meteo. """
     try:
         # Fetch weather data from Open-Meteo API
-        url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current_weather=true"
-        response = requests.get(url)
-        data = response.json()
+        url = WEATHER_URL_FMT % (lat, lon)
+        response = _http.get(url, headers=WEATHER_HEADERS, timeout=HTTP_TIMEOUT)
+        data = json_loads(response.content)
 
         # Extract weather information
         weather_code = data['current_weather']['weathercode']
@@ -122,71 +258,113 @@ def get_weather(lat, lon):
         weather_desc = weather_code_map.get(weather_code, "Unknown weather condition")
         return f"{weather_desc}, {temperature}"
 
+    except (requests.Timeout, requests.ConnectionError):
+        print("Error fetching weather: could not reach Open-Meteo")
+        return "Weather unavailable"
+
     except Exception as e:
         # Print the full traceback for debugging
         print("Error fetching weather:")
         return "Weather unavailable"
 
 
+def refresh_context():
+    """ Refreshes location and weather every REFRESH_INTERVAL seconds, or sooner when woken. """
+    while True:
+        _refresh_event.clear()
+        interval = REFRESH_INTERVAL
+        try:
+            if params["add_location"]:
+                location = get_location()
+                latlng = location[2]
+                weather = get_weather(latlng[0], latlng[1]) if params["add_weather"] and latlng else None
+                _latest_context["value"] = (location, weather)
+
+                # Retry soon after a failure instead of showing it for the full interval
+                if latlng is None or weather == "Weather unavailable":
+                    interval = RETRY_INTERVAL
+        except Exception as e:
+            # Keep the only refresher thread alive through unexpected errors
+            print(f"Error refreshing location and weather: {e}")
+            interval = RETRY_INTERVAL
+        _refresh_event.wait(interval)
+
+
+def get_timezone():
+    """ Returns the tzinfo for the selected timezone, reusing it until the setting changes. """
+    if _tz_cache["name"] != params["timezone"]:
+        try:
+            _tz_cache["tz"] = ZoneInfo(params["timezone"])
+            _tz_cache["display"] = params["timezone"]
+        except (ZoneInfoNotFoundError, ValueError):
+            # Names saved from older pytz-based settings, or a missing tz database,
+            # fall back to UTC without touching the saved setting
+            print(f"Unknown timezone {params['timezone']}, using UTC")
+            _tz_cache["tz"] = datetime.timezone.utc
+            _tz_cache["display"] = "UTC"
+        _tz_cache["name"] = params["timezone"]
+    return _tz_cache["tz"]
+
+
+def get_locale():
+    """ Returns the parsed Babel locale for the selected locale, reusing it until the setting changes. """
+    if _locale_cache["name"] != params["locale"]:
+        _locale_cache["locale"] = Locale.parse(params["locale"])
+        _locale_cache["name"] = params["locale"]
+    return _locale_cache["locale"]
+
+
+@functools.lru_cache(maxsize=1)
+def get_timezone_choices():
+    """ Returns the sorted list of available timezone names, built on first use. """
+    return sorted(available_timezones())
+
+
 def chat_input_modifier(text, visible_text, state):
     """ Modifies the input text based on the user's settings and locale. """
-    additions = []
-    now = datetime.datetime.now(pytz.timezone(params["timezone"]))
-    
-    # Get the user's selected locale for formatting
-    user_locale = Locale.parse(params["locale"])
+    # Fixed slots for datetime, timezone, location and weather; unused ones stay None
+    additions = [None] * 4
 
-    if params["add_time"] or params["add_date"]:
-        # Format the date and time based on the locale
-        formatted_datetime = format_datetime(now, locale=user_locale)
-        additions.append(f"Current date and time: {formatted_datetime}")
+    datetime_format = datetime_formats.get((params["add_time"], params["add_date"]))
+    if datetime_format:
+        # Build the current time once and format it based on the user's locale
+        label, formatter = datetime_format
+        now = datetime.datetime.now(get_timezone())
+        additions[0] = f"{label}: {formatter(now, locale=get_locale())}"
 
     if params["add_timezone"]:
-        current_timezone = params["timezone"]
-        additions.append(f"Timezone: {current_timezone}")
-
-    if params["add_location"]:
-        city, country, latlng = get_location()
-        additions.append(f"Location: {city}, {country}")
+        # Report the timezone actually used for the time above when it has been resolved
+        if _tz_cache["name"] == params["timezone"]:
+            current_timezone = _tz_cache["display"]
+        else:
+            current_timezone = params["timezone"]
+        additions[1] = f"Timezone: {current_timezone}"
+
+    # Location and weather come from the background refresher; they are left out
+    # until its first lookup completes rather than blocking this turn
+    latest = _latest_context["value"]
+    if params["add_location"] and latest is not None:
+        (city, country, latlng), weather = latest
+        additions[2] = f"Location: {city}, {country}"
         
-        if params["add_weather"] and latlng:
-            weather = get_weather(latlng[0], latlng[1])
-            additions.append(f"Weather: {weather}")
+        if params["add_weather"] and weather is not None:
+            additions[3] = f"Weather: {weather}"
     
-    modified_text = f"{text}\n[{' | '.join(additions)}]" if additions else text
+    context = ' | '.join(filter(None, additions))
+    modified_text = f"{text}\n[{context}]" if context else text
     return modified_text, visible_text
 
 
-def ui():
-    """Creates Gradio UI components."""
-    def update_add_time(value):
-        params["add_time"] = value
-        save_settings()
-
-    def update_add_date(value):
-        params["add_date"] = value
-        save_settings()
-
-    def update_timezone(value):
-        params["timezone"] = value
-        save_settings()
+def update_param(key, value):
+    """ Stores a changed UI setting and schedules it to be saved. """
+    params[key] = value
+    schedule_save()
+    if key in REFRESH_PARAMS:
+        _refresh_event.set()
 
-    def update_add_location(value):
-        params["add_location"] = value
-        save_settings()
-
-    def update_add_weather(value):
-        params["add_weather"] = value
-        save_settings()
-
-    def update_temp_unit(value):
-        params["temp_unit"] = value
-        save_settings()
-
-    def update_locale(value):
-        params["locale"] = value
-        save_settings()
 
+def ui():
+    """Creates Gradio UI components."""
     with gr.Accordion("Locality Settings", open=False):
         with gr.Row():
             with gr.Column(): 
@@ -209,7 +387,7 @@ def ui():
                 )
                 timezone_dropdown = gr.Dropdown(
                     label="Select Timezone",
-                    choices=pytz.all_timezones,
+                    choices=get_timezone_choices(),
                     value=params["timezone"]
                 )
                 add_weather_checkbox = gr.Checkbox(
@@ -223,12 +401,12 @@ def ui():
                 )
 
         # Event handling for UI interactions
-        locale_dropdown.change(update_locale, locale_dropdown, None)
-        add_time_checkbox.change(update_add_time, add_time_checkbox, None)
-        add_date_checkbox.change(update_add_date, add_date_checkbox, None)
-        add_location_checkbox.change(update_add_location, add_location_checkbox, None)
-        add_weather_checkbox.change(update_add_weather, add_weather_checkbox, None)
-        temp_unit_dropdown.change(update_temp_unit, temp_unit_dropdown, None)
-        timezone_dropdown.change(update_timezone, timezone_dropdown, None)
+        locale_dropdown.change(functools.partial(update_param, "locale"), locale_dropdown, None)
+        add_time_checkbox.change(functools.partial(update_param, "add_time"), add_time_checkbox, None)
+        add_date_checkbox.change(functools.partial(update_param, "add_date"), add_date_checkbox, None)
+        add_location_checkbox.change(functools.partial(update_param, "add_location"), add_location_checkbox, None)
+        add_weather_checkbox.change(functools.partial(update_param, "add_weather"), add_weather_checkbox, None)
+        temp_unit_dropdown.change(functools.partial(update_param, "temp_unit"), temp_unit_dropdown, None)
+        timezone_dropdown.change(functools.partial(update_param, "timezone"), timezone_dropdown, None)
 
 setup()